@@ -1,33 +1,71 @@
 import os
-import re
+import queue
+import threading
 import tempfile
-import requests
+import httpx
+from concurrent.futures import ThreadPoolExecutor
 import streamlit as st
+import torch
 from bs4 import BeautifulSoup
-import whisper
+from faster_whisper import BatchedInferencePipeline, WhisperModel
 from transformers import pipeline
 import csv
 from tqdm import tqdm
 
-# Load summarization pipeline locally once at startup
-summarizer = pipeline("summarization", model="facebook/bart-large-cnn")
+DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+
+# Recordings and cached transcripts live here for the lifetime of the app
+os.makedirs("temp_recordings", exist_ok=True)
+
+# distilbart is a distilled bart-large-cnn; override with SUMMARIZER_MODEL
+SUMMARIZER_MODEL = os.environ.get("SUMMARIZER_MODEL", "sshleifer/distilbart-cnn-12-6")
+SUMMARY_BATCH_SIZE = 8
+# Token limits at or above this are tokenizer placeholders, not real model limits
+SUMMARY_UNBOUNDED_TOKENS = 1_000_000
+
+CSV_FIELDS = ["Call ID", "Date (+time)", "From", "To", "Summary"]
+
+@st.cache_resource
+def get_summarizer():
+    # Load summarization pipeline locally once and reuse it across reruns
+    summarizer = pipeline("summarization", model=SUMMARIZER_MODEL, device=DEVICE)
+    if DEVICE == "cuda":
+        # Compile the forward pass used by generate(); warmup is paid once per cache
+        summarizer.model.forward = torch.compile(summarizer.model.forward, dynamic=True)
+    return summarizer
+
+@st.cache_resource
+def get_whisper_model():
+    compute_type = "float16" if DEVICE == "cuda" else "int8"
+    model = WhisperModel("small", device=DEVICE, compute_type=compute_type)
+    return BatchedInferencePipeline(model=model)
+
+# Characters that are unsafe in filenames, mapped to underscores
+_FILENAME_TABLE = str.maketrans(dict.fromkeys('<>:"/\\|?* ', '_'))
 
 def sanitize_filename(s):
-    return re.sub(r'[<>:"/\\|?* ]', '_', s)
+    return s.translate(_FILENAME_TABLE)
 
 def parse_html_calls(html_content):
-    soup = BeautifulSoup(html_content, 'html.parser')
+    soup = BeautifulSoup(html_content, 'lxml')
     calls = []
+    seen_ids = set()
 
     for row in soup.select("tr.recording"):
         data_id = row.get("data-id")
-        date_td = row.find('td', class_='date')
+        # Walk the row's cells once and look them up by class or position
+        tds = row.find_all('td')
+        cells = {}
+        for td in tds:
+            for cls in td.get('class', []):
+                cells.setdefault(cls, td)
+        date_td = cells.get('date')
         full_date = date_td.text.strip() if date_td else ""
-        rec_td = row.find('td', class_='rec')
+        rec_td = cells.get('rec')
         rec_number = rec_td.find('span', class_='phonenumber').text.strip() if rec_td else ""
-        from_td = row.find('td', class_='from')
+        from_td = cells.get('from')
         from_number = from_td.find('span', class_='phonenumber').text.strip().replace(" ", "") if from_td else ""
-        to_td = row.find_all('td')[4] if len(row.find_all('td')) > 4 else None
+        to_td = tds[4] if len(tds) > 4 else None
         to_number = to_td.find('span', class_='phonenumber').text.strip().replace(" ", "") if to_td else ""
 
         if rec_number == "*200":
@@ -37,7 +75,9 @@ def parse_html_calls(html_content):
         else:
             user_tag = "UnknownUser"
 
-        if data_id:
+        # A recording can appear on the page more than once; keep the first row
+        if data_id and data_id not in seen_ids:
+            seen_ids.add(data_id)
             calls.append({
                 "data_id": data_id,
                 "date_time": full_date,
@@ -48,29 +88,127 @@ def parse_html_calls(html_content):
 
     return calls
 
-def download_audio(session, call):
+def download_audio(client, call):
     fn = f"{sanitize_filename(call['date_time'])}_{call['from_number']}_{call['to_number']}_{call['user_tag']}_{call['data_id']}.mp3"
     filepath = os.path.join("temp_recordings", fn)
-    if not os.path.exists("temp_recordings"):
-        os.makedirs("temp_recordings")
     if os.path.exists(filepath):
         return filepath
     url = f"https://controlpanel.voipfone.co.uk/api/srv?callRecordingsGetFile/{call['data_id']}.mp3"
-    resp = session.get(url, stream=True)
-    resp.raise_for_status()
-    with open(filepath, "wb") as f:
-        for chunk in resp.iter_content(chunk_size=8192):
-            f.write(chunk)
+    # Download to a .part file and rename, so an interrupted download is never reused
+    with client.stream("GET", url) as resp:
+        resp.raise_for_status()
+        with open(filepath + ".part", "wb") as f:
+            for chunk in resp.iter_bytes(chunk_size=1 << 20):
+                f.write(chunk)
+    os.replace(filepath + ".part", filepath)
     return filepath
 
+def transcript_cache_path(call):
+    return os.path.join("temp_recordings", f"{call['data_id']}.txt")
+
+def load_processed_ids(csv_path):
+    # Call IDs already summarized by a previous run, or None if there is no CSV to resume
+    if not os.path.exists(csv_path):
+        return None
+    with open(csv_path, newline="", encoding="utf-8") as f:
+        reader = csv.DictReader(f)
+        if reader.fieldnames != CSV_FIELDS:
+            return None
+        return {row["Call ID"] for row in reader}
+
 def transcribe_audio(model, path):
-    result = model.transcribe(path, task="translate")
-    return result["text"]
+    # The batched pipeline runs Silero VAD by default; kept explicit so silence is skipped
+    segments, _ = model.transcribe(
+        path,
+        task="translate",
+        beam_size=1,
+        batch_size=16,
+        vad_filter=True,
+    )
+    return " ".join(segment.text for segment in segments).strip()
 
-def summarize_text(text):
-    # Use local summarization pipeline
-    summaries = summarizer(text, max_length=150, min_length=40, do_sample=False)
-    return summaries[0]['summary_text']
+def summarize_texts(summarizer, texts):
+    # Truncate to the model's token limit and generate the batch in one call
+    tokenizer, model = summarizer.tokenizer, summarizer.model
+    # model_max_length is a ~1e30 placeholder when the tokenizer has no known limit
+    limits = [tokenizer.model_max_length, getattr(model.config, "max_position_embeddings", None)]
+    max_tokens = min((n for n in limits if n and n < SUMMARY_UNBOUNDED_TOKENS), default=1024)
+    # The pipeline keeps the task prefix (T5's "summarize: ") and its task-specific
+    # generation settings on itself, not on the model config
+    prefix = summarizer.prefix or ""
+    inputs = tokenizer(
+        [prefix + text for text in texts],
+        truncation=True,
+        max_length=max_tokens,
+        padding=True,
+        return_tensors="pt",
+    ).to(model.device)
+    with torch.inference_mode():
+        summary_ids = model.generate(
+            **inputs,
+            generation_config=summarizer.generation_config,
+            max_length=150,
+            min_length=40,
+            do_sample=False,
+        )
+    return tokenizer.batch_decode(summary_ids, skip_special_tokens=True)
+
+def summarize_worker(summarizer, summary_q, csv_file, results, errors, lock):
+    writer = csv.DictWriter(csv_file, fieldnames=CSV_FIELDS)
+
+    # Consume (call, transcript) pairs in batches until a None sentinel arrives. Batches
+    # only take what is already queued: while Whisper is the slower stage they are
+    # mostly single calls, and they fill up when transcripts come from the cache
+    finished = False
+    while not finished:
+        batch = []
+        item = summary_q.get()
+        while item is not None:
+            batch.append(item)
+            if len(batch) == SUMMARY_BATCH_SIZE:
+                break
+            try:
+                item = summary_q.get_nowait()
+            except queue.Empty:
+                break
+        finished = item is None
+        if not batch:
+            continue
+
+        # Retry a failed batch one call at a time, so an OOM or bad input only fails that call
+        summarized = []
+        try:
+            transcripts = [transcript for _, transcript in batch]
+            summarized = list(zip([call for call, _ in batch], summarize_texts(summarizer, transcripts)))
+        except Exception:
+            for call, transcript in batch:
+                try:
+                    summarized.append((call, summarize_texts(summarizer, [transcript])[0]))
+                except Exception as e:
+                    with lock:
+                        errors.append((call, e))
+
+        try:
+            rows = [
+                {
+                    "Call ID": call["data_id"],
+                    "Date (+time)": call["date_time"],
+                    "From": call["from_number"],
+                    "To": call["to_number"],
+                    "Summary": summary
+                }
+                for call, summary in summarized
+            ]
+
+            # Flush rows after every batch to save progress incrementally
+            writer.writerows(rows)
+            csv_file.flush()
+
+            with lock:
+                results.extend(rows)
+        except Exception as e:
+            with lock:
+                errors.extend((call, e) for call, _ in summarized)
 
 st.title("Mortgage Call Downloader, Transcriber & Summarizer")
 
@@ -84,48 +222,98 @@ if uploaded_html and cookie_name and cookie_value:
     st.write(f"Detected {len(calls)} calls in HTML.")
 
     if st.button("Download recordings & process"):
-        session = requests.Session()
-        session.cookies.set(cookie_name, cookie_value, domain=".voipfone.co.uk")
-        model = whisper.load_model("small")
+        model = get_whisper_model()
+        summarizer = get_summarizer()
         results = []
         progress_bar = st.progress(0)
 
         csv_path = "calls_summary.csv"
-        # Write header once before loop
-        with open(csv_path, "w", newline="", encoding="utf-8") as f:
-            writer = csv.DictWriter(f, fieldnames=["Date (+time)", "From", "To", "Summary"])
-            writer.writeheader()
+        processed = load_processed_ids(csv_path)
+        resume = processed is not None
+        pending = [call for call in calls if call["data_id"] not in (processed or set())]
+        if resume:
+            st.write(f"Skipping {len(calls) - len(pending)} calls already in {csv_path}.")
 
-        for i, call in enumerate(calls):
-            st.write(f"Processing call {i+1}/{len(calls)}: {call['data_id']}")
-            try:
-                mp3_path = download_audio(session, call)
-                transcript = transcribe_audio(model, mp3_path)
-                summary = summarize_text(transcript)
-
-                # Append row to CSV after every call to save progress incrementally
-                with open(csv_path, "a", newline="", encoding="utf-8") as f:
-                    writer = csv.DictWriter(f, fieldnames=["Date (+time)", "From", "To", "Summary"])
-                    writer.writerow({
-                        "Date (+time)": call["date_time"],
-                        "From": call["from_number"],
-                        "To": call["to_number"],
-                        "Summary": summary
-                    })
-
-                results.append({
-                    "Date (+time)": call["date_time"],
-                    "From": call["from_number"],
-                    "To": call["to_number"],
-                    "Summary": summary
-                })
+        # Open the CSV here so a locked or unwritable file fails visibly before any work starts
+        csv_file = open(csv_path, "a" if resume else "w", newline="", encoding="utf-8")
+        if not resume:
+            csv.DictWriter(csv_file, fieldnames=CSV_FIELDS).writeheader()
+
+        # Summaries run on a background thread so transcription never waits on them
+        summary_q = queue.Queue(maxsize=16)
+        summary_errors = []
+        lock = threading.Lock()
+        summary_thread = threading.Thread(
+            target=summarize_worker,
+            args=(summarizer, summary_q, csv_file, results, summary_errors, lock),
+            daemon=True,
+        )
+        summary_thread.start()
+        failed = 0
+
+        def update_progress():
+            with lock:
+                done = len(results) + len(summary_errors) + failed
+            progress_bar.progress(done / max(len(pending), 1))
+
+        try:
+            # One HTTP/2 client shared by the download threads multiplexes their streams
+            with httpx.Client(
+                http2=True,
+                limits=httpx.Limits(max_connections=8),
+                timeout=60.0,
+                follow_redirects=True,
+            ) as client:
+                client.cookies.set(cookie_name, cookie_value, domain=".voipfone.co.uk")
+
+                # Fetch recordings concurrently; transcription consumes them in order
+                executor = ThreadPoolExecutor(max_workers=8)
+                try:
+                    # Calls with a cached transcript skip both download and Whisper
+                    downloads = [
+                        None if os.path.exists(transcript_cache_path(call))
+                        else executor.submit(download_audio, client, call)
+                        for call in pending
+                    ]
+                    for i, (call, download) in enumerate(zip(pending, downloads)):
+                        st.write(f"Processing call {i+1}/{len(pending)}: {call['data_id']}")
+                        try:
+                            if download is None:
+                                with open(transcript_cache_path(call), encoding="utf-8") as f:
+                                    transcript = f.read()
+                            else:
+                                transcript = transcribe_audio(model, download.result())
+                                # Write then rename so only complete transcripts ever look cached
+                                cache_path = transcript_cache_path(call)
+                                with open(cache_path + ".tmp", "w", encoding="utf-8") as f:
+                                    f.write(transcript)
+                                os.replace(cache_path + ".tmp", cache_path)
+                            summary_q.put((call, transcript))
+                        except Exception as e:
+                            st.error(f"Error processing call {call['data_id']}: {e}")
+                            failed += 1
+
+                        update_progress()
+                finally:
+                    # Every consumed download is finished; on Stop or a rerun, drop the
+                    # queued ones instead of waiting for all of them to download
+                    executor.shutdown(wait=False, cancel_futures=True)
 
-            except Exception as e:
-                st.error(f"Error processing call {call['data_id']}: {e}")
+            summary_q.put(None)
+            while summary_thread.is_alive():
+                summary_thread.join(timeout=0.5)
+                update_progress()
+        finally:
+            # On a rerun or error, let the worker drain what is queued before the CSV closes
+            if summary_thread.is_alive():
+                summary_q.put(None)
+                summary_thread.join()
+            csv_file.close()
 
-            progress_bar.progress((i + 1) / len(calls))
+        for call, e in summary_errors:
+            st.error(f"Error summarizing call {call['data_id']}: {e}")
 
-        if results:
+        if results or processed:
             st.success("Processing complete! Download CSV below.")
-            with open(csv_path, "r", encoding="utf-8") as f:
-                st.download_button("Download CSV", data=f.read(), file_name=csv_path)
+            with open(csv_path, "rb") as f:
+                st.download_button("Download CSV", data=f.read(), file_name=csv_path, mime="text/csv")